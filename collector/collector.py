@@ -1,11 +1,33 @@
 import os
 import time
+import queue
+import random
+import calendar
 import sqlite3
 import logging
-from datetime import datetime, timezone
-from typing import Any, Dict, Optional, Tuple
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from json import JSONDecodeError
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
+
+try:
+    # orjson parses the (potentially multi-MB) SIRI payload much faster.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # Optional: stream VehicleActivity items instead of materializing the whole payload.
+    import ijson
+except ImportError:
+    ijson = None
 
 """
 MetroMind Collector (Fixed)
@@ -16,7 +38,8 @@ What it does:
 - Tracks each bus (VehicleRef) across polls.
 - Detects stop-to-stop movement using MonitoredCall.StopPointRef.
 - When the next stop changes, records a segment: from_stop -> to_stop with travel time.
-- Writes every valid segment immediately to SQLite (no prediction/analysis).
+- Queues each tick's valid segments for a background writer thread, which commits
+  them to SQLite in one transaction per tick (no prediction/analysis).
 - Handles missing/bad data by skipping safely and continuing.
 
 Storage:
@@ -55,6 +78,9 @@ DETAIL_LEVEL = os.getenv("DETAIL_LEVEL", "normal")  # default to normal
 # Request timeout (seconds) — larger payloads need longer timeout.
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "60"))
 
+# Upper bound on the wait between polls after repeated network/API failures (seconds)
+MAX_BACKOFF_SECONDS = int(os.getenv("MAX_BACKOFF_SECONDS", "600"))
+
 # SQLite DB file
 DB_PATH = os.getenv("METROMIND_DB", "/workspaces/MetroMind/metromind_memory.sqlite")
 
@@ -62,6 +88,12 @@ DB_PATH = os.getenv("METROMIND_DB", "/workspaces/MetroMind/metromind_memory.sqli
 MIN_SEGMENT_SECONDS = int(os.getenv("MIN_SEGMENT_SECONDS", "10"))
 MAX_SEGMENT_SECONDS = int(os.getenv("MAX_SEGMENT_SECONDS", "3600"))
 
+# Attempts per tick batch when SQLite is busy/locked before the batch is dropped
+DB_WRITE_ATTEMPTS = int(os.getenv("DB_WRITE_ATTEMPTS", "5"))
+
+# How long shutdown waits for the writer to flush queued ticks (seconds)
+SHUTDOWN_TIMEOUT_SECONDS = int(os.getenv("SHUTDOWN_TIMEOUT_SECONDS", "10"))
+
 # Debug (set DEBUG_SAMPLE=1 to print sample keys once per run)
 DEBUG_SAMPLE = os.getenv("DEBUG_SAMPLE", "0") == "1"
 
@@ -75,6 +107,36 @@ logging.basicConfig(
 )
 
 
+# ----------------------------
+# HTTP SESSION
+# ----------------------------
+# One pooled session for the whole run so polls reuse the TCP/TLS connection
+# instead of paying a full handshake every tick.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        # Retries transient server errors within a poll. 429/503 are not retried here:
+        # they come straight back to main(), whose backoff is the one place Retry-After
+        # is honored (urllib3 would otherwise sleep it before each retry as well).
+        max_retries=Retry(
+            total=5,
+            backoff_factor=2,
+            status_forcelist=[500, 502, 504],
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        ),
+    ),
+)
+SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip, deflate"})
+
+# Validators from the last fully ingested 200 response, sent back as If-None-Match / If-Modified-Since
+# so an unchanged feed costs a 304 instead of a full download + parse.
+CONDITIONAL_HEADERS: Dict[str, str] = {}
+
+
 # ----------------------------
 # HELPERS
 # ----------------------------
@@ -101,8 +163,63 @@ def parse_iso8601(ts: Any) -> Optional[datetime]:
         return None
 
 
-def utc_iso(dt: datetime) -> str:
-    return dt.astimezone(timezone.utc).isoformat()
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_US = timedelta(microseconds=1)
+
+
+# Timestamp parsing is the bulk of per-activity CPU. Within a tick nearly every
+# RecordedAtTime shares a handful of minute prefixes and "[.fff]+HH:MM" tails, so
+# both halves are memoized and a parse is two cache hits plus one int().
+@lru_cache(maxsize=1024)
+def _minute_epoch(prefix: str) -> int:
+    """'YYYY-MM-DDTHH:MM' -> epoch seconds, before any UTC offset is applied."""
+    return calendar.timegm(datetime.strptime(prefix, "%Y-%m-%dT%H:%M").timetuple())
+
+
+@lru_cache(maxsize=4096)
+def _tail_us(tail: str) -> int:
+    """'[.ffffff](Z|+HH:MM|-HH:MM)' -> microseconds to add (fraction minus UTC offset)."""
+    us = 0
+    i = 0
+    if tail[:1] == ".":
+        i = 1
+        while i < len(tail) and tail[i].isdigit():
+            i += 1
+        if i > 1:
+            us = int(tail[1:i][:6].ljust(6, "0"))
+
+    tz = tail[i:]
+    if tz == "Z":
+        return us
+    if len(tz) == 6 and tz[0] in "+-" and tz[3] == ":" and tz[1:3].isdigit() and tz[4:6].isdigit():
+        offset = (int(tz[1:3]) * 3600 + int(tz[4:6]) * 60) * 1_000_000
+        return us - offset if tz[0] == "+" else us + offset
+    raise ValueError(f"unsupported timestamp suffix: {tail!r}")
+
+
+def ts_to_epoch_us(ts: Any) -> Optional[int]:
+    """
+    Parse an ISO8601 timestamp into integer UTC microseconds since the epoch.
+    SIRI's fixed YYYY-MM-DDTHH:MM:SS[.fff](Z|+HH:MM) layout is sliced directly;
+    anything else goes through parse_iso8601.
+    """
+    if not ts or not isinstance(ts, str):
+        return None
+    try:
+        seconds = ts[17:19]
+        if len(ts) >= 20 and ts[16] == ":" and seconds.isdigit() and seconds < "60":
+            return (_minute_epoch(ts[:16]) + int(seconds)) * 1_000_000 + _tail_us(ts[19:])
+    except ValueError:
+        pass
+
+    dt = parse_iso8601(ts)
+    if dt is None:
+        return None
+    return (dt.astimezone(timezone.utc) - _EPOCH) // _ONE_US
+
+
+def epoch_us_to_iso(us: int) -> str:
+    return (_EPOCH + timedelta(microseconds=us)).isoformat()
 
 
 def now_utc_iso() -> str:
@@ -112,10 +229,21 @@ def now_utc_iso() -> str:
 # ----------------------------
 # DB
 # ----------------------------
+# In-memory mirror of vehicle_state (vehicle_ref -> row), primed once at startup
+# so per-observation lookups never touch SQLite. First-seen times are kept as
+# integer epoch microseconds and only formatted back to ISO text when written.
+STATE: Dict[str, Dict[str, Any]] = {}
+
+
 def db_connect() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")            # collector and phase5 share the DB
+    conn.execute("PRAGMA cache_size=-65536;")           # 64 MiB page cache
+    conn.execute("PRAGMA mmap_size=268435456;")         # 256 MiB memory-mapped reads
+    conn.execute("PRAGMA temp_store=MEMORY;")           # temp tables / sorts stay in RAM
+    conn.execute("PRAGMA wal_autocheckpoint=2000;")
     return conn
 
 
@@ -153,52 +281,79 @@ def db_init(conn: sqlite3.Connection) -> None:
     conn.commit()
 
 
-def load_vehicle_state(conn: sqlite3.Connection, vehicle_ref: str) -> Optional[Dict[str, str]]:
-    row = conn.execute(
+def prime_vehicle_state(conn: sqlite3.Connection) -> None:
+    """(Re)load the in-memory STATE mirror from the vehicle_state table."""
+    STATE.clear()
+    for row in conn.execute(
         "SELECT vehicle_ref, route_id, direction_id, trip_id, current_stop_id, current_stop_first_seen_utc "
-        "FROM vehicle_state WHERE vehicle_ref = ?",
-        (vehicle_ref,),
-    ).fetchone()
-    if not row:
-        return None
-    return {
-        "vehicle_ref": row[0],
-        "route_id": row[1] or "",
-        "direction_id": row[2] or "",
-        "trip_id": row[3] or "",
-        "current_stop_id": row[4] or "",
-        "current_stop_first_seen_utc": row[5] or "",
-    }
+        "FROM vehicle_state"
+    ):
+        STATE[row[0]] = {
+            "vehicle_ref": row[0],
+            "route_id": row[1] or "",
+            "direction_id": row[2] or "",
+            "trip_id": row[3] or "",
+            "current_stop_id": row[4] or "",
+            "current_stop_first_seen_us": ts_to_epoch_us(row[5]),
+        }
+
+
+def load_vehicle_state(vehicle_ref: str) -> Optional[Dict[str, Any]]:
+    return STATE.get(vehicle_ref)
+
+
+UPSERT_VEHICLE_STATE_SQL = """
+    INSERT INTO vehicle_state (
+        vehicle_ref, route_id, direction_id, trip_id, current_stop_id, current_stop_first_seen_utc
+    )
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(vehicle_ref) DO UPDATE SET
+        route_id=excluded.route_id,
+        direction_id=excluded.direction_id,
+        trip_id=excluded.trip_id,
+        current_stop_id=excluded.current_stop_id,
+        current_stop_first_seen_utc=excluded.current_stop_first_seen_utc
+"""
+
+INSERT_SEGMENT_SQL = """
+    INSERT INTO segments (
+        route_id, direction_id, vehicle_ref, trip_id,
+        from_stop_id, to_stop_id,
+        depart_time_utc, arrive_time_utc,
+        travel_time_seconds, recorded_at_utc
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
 
 def upsert_vehicle_state(
-    conn: sqlite3.Connection,
+    state_rows: List[tuple],
     vehicle_ref: str,
     route_id: str,
     direction_id: str,
     trip_id: str,
     stop_id: str,
-    first_seen_utc: str,
+    first_seen_us: Optional[int],
 ) -> None:
-    conn.execute(
-        """
-        INSERT INTO vehicle_state (
-            vehicle_ref, route_id, direction_id, trip_id, current_stop_id, current_stop_first_seen_utc
-        )
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(vehicle_ref) DO UPDATE SET
-            route_id=excluded.route_id,
-            direction_id=excluded.direction_id,
-            trip_id=excluded.trip_id,
-            current_stop_id=excluded.current_stop_id,
-            current_stop_first_seen_utc=excluded.current_stop_first_seen_utc
-        """,
-        (vehicle_ref, route_id, direction_id, trip_id, stop_id, first_seen_utc),
-    )
+    state = {
+        "vehicle_ref": vehicle_ref,
+        "route_id": route_id,
+        "direction_id": direction_id,
+        "trip_id": trip_id,
+        "current_stop_id": stop_id,
+        "current_stop_first_seen_us": first_seen_us,
+    }
+    # Most polls see the bus still heading to the same stop; only queue a write when the row changes.
+    if STATE.get(vehicle_ref) == state:
+        return
+
+    STATE[vehicle_ref] = state
+    first_seen_utc = epoch_us_to_iso(first_seen_us) if first_seen_us is not None else ""
+    state_rows.append((vehicle_ref, route_id, direction_id, trip_id, stop_id, first_seen_utc))
 
 
 def insert_segment(
-    conn: sqlite3.Connection,
+    seg_rows: List[tuple],
     route_id: str,
     direction_id: str,
     vehicle_ref: str,
@@ -209,16 +364,7 @@ def insert_segment(
     arrive_utc: str,
     travel_seconds: int,
 ) -> None:
-    conn.execute(
-        """
-        INSERT INTO segments (
-            route_id, direction_id, vehicle_ref, trip_id,
-            from_stop_id, to_stop_id,
-            depart_time_utc, arrive_time_utc,
-            travel_time_seconds, recorded_at_utc
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
+    seg_rows.append(
         (
             route_id,
             direction_id,
@@ -230,14 +376,89 @@ def insert_segment(
             arrive_utc,
             int(travel_seconds),
             now_utc_iso(),
-        ),
+        )
     )
 
 
+def write_tick(conn: sqlite3.Connection, seg_rows: List[tuple], state_rows: List[tuple]) -> None:
+    """Flush one tick's queued rows in a single transaction (one executemany per table)."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(INSERT_SEGMENT_SQL, seg_rows)
+        conn.executemany(UPSERT_VEHICLE_STATE_SQL, state_rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def db_writer(write_queue: queue.Queue, dropped: threading.Event) -> None:
+    """
+    Single SQLite writer thread: commits queued tick batches while the main loop
+    waits for and fetches the next tick. A None batch stops the thread.
+    A batch that cannot be written is dropped and `dropped` is set so the main
+    loop reloads STATE from the DB.
+    """
+    conn = db_connect()
+    try:
+        while True:
+            batch = write_queue.get()
+            try:
+                if batch is None:
+                    return
+                # Later ticks were already built on the STATE this batch records, so
+                # retry it while SQLite is merely busy/locked (the bounded queue holds
+                # the main loop back meanwhile); anything else won't clear up on retry.
+                attempt = 0
+                while True:
+                    attempt += 1
+                    try:
+                        write_tick(conn, *batch)
+                        break
+                    except Exception as e:
+                        busy = isinstance(e, sqlite3.OperationalError) and (
+                            "locked" in str(e) or "busy" in str(e)
+                        )
+                        if not busy or attempt >= DB_WRITE_ATTEMPTS:
+                            logging.error(f"DB write error, dropping tick after {attempt} attempt(s): {e}")
+                            dropped.set()
+                            break
+                        wait = min(POLL_SECONDS, 2 ** attempt)
+                        logging.warning(f"DB busy (attempt {attempt}), retrying in {wait}s: {e}")
+                        time.sleep(wait)
+            finally:
+                write_queue.task_done()
+    finally:
+        conn.close()
+
+
 # ----------------------------
 # API
 # ----------------------------
-def fetch_vehicle_monitoring() -> Dict[str, Any]:
+def backoff_seconds(failures: int, error: Exception) -> float:
+    """Jittered exponential wait after `failures` consecutive failed polls, at least any Retry-After."""
+    delay = min(MAX_BACKOFF_SECONDS, POLL_SECONDS * 2 ** min(failures - 1, 16) * random.uniform(0.5, 1.5))
+
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                wait = 0.0
+        delay = max(delay, wait)
+    return delay
+
+
+def fetch_vehicle_monitoring() -> Optional[Tuple[requests.Response, Dict[str, str]]]:
+    """
+    Start the SIRI request; the body is consumed lazily by iter_vehicle_activities.
+    Returns (response, validators), where validators are the conditional headers
+    for the next poll; None when the feed is unchanged since the last poll (HTTP 304).
+    """
     params: Dict[str, Any] = {
         "key": API_KEY,
         "version": SIRI_VERSION,
@@ -248,16 +469,97 @@ def fetch_vehicle_monitoring() -> Dict[str, Any]:
     if DIRECTION_REF:
         params["DirectionRef"] = DIRECTION_REF
 
-    r = requests.get(BASE_URL, params=params, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
-    return r.json()
+    r = SESSION.get(BASE_URL, params=params, headers=CONDITIONAL_HEADERS, timeout=REQUEST_TIMEOUT, stream=True)
+    if r.status_code == 304:
+        r.close()
+        return None
+    try:
+        r.raise_for_status()
+    except requests.HTTPError:
+        r.close()
+        raise
+
+    validators: Dict[str, str] = {}
+    if r.headers.get("ETag"):
+        validators["If-None-Match"] = r.headers["ETag"]
+    if r.headers.get("Last-Modified"):
+        validators["If-Modified-Since"] = r.headers["Last-Modified"]
+    return r, validators
 
 
 # ----------------------------
 # EXTRACTION
 # ----------------------------
+# ijson prefix of VehicleMonitoringDelivery (may be a list or a dict)
+DELIVERY_PREFIX = "Siri.ServiceDelivery.VehicleMonitoringDelivery"
+
+
+def iter_vehicle_activities(resp: requests.Response) -> Iterator[Dict[str, Any]]:
+    """
+    Yield VehicleActivity items from a response.
+    Only the unfiltered (whole-network) feed is streamed with ijson: it is ~3x
+    slower than orjson per byte, so a single-route payload is parsed whole.
+    """
+    try:
+        if ijson is not None and not LINE_REF:
+            resp.raw.decode_content = True  # let urllib3 gunzip
+            try:
+                yield from stream_vehicle_activities(resp.raw)
+            except (Urllib3HTTPError, ijson.IncompleteJSONError) as e:
+                # Reading resp.raw bypasses requests' wrapping of body errors; re-raise a
+                # dropped connection / read timeout / truncated body as a network failure.
+                raise requests.ConnectionError(e, response=resp) from e
+        else:
+            try:
+                payload = json_loads(resp.content)
+            except JSONDecodeError as e:
+                # Like resp.json(): an unparsable (e.g. truncated) body is an API failure.
+                raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos) from e
+            yield from extract_vehicle_activities(payload)
+    finally:
+        resp.close()
+
+
+class _ReplayReader:
+    """File-like over `raw` that can replay the chunks read while sniffing the payload's shape."""
+
+    def __init__(self, raw: Any):
+        self.raw = raw
+        self.chunks: List[bytes] = []
+        self.recording = True
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.recording and self.chunks:
+            return self.chunks.pop(0)
+        data = self.raw.read(size)
+        if self.recording:
+            self.chunks.append(data)
+        return data
+
+
+def stream_vehicle_activities(raw: Any) -> Iterator[Dict[str, Any]]:
+    """Build one VehicleActivity dict at a time so the full payload never sits in memory."""
+    # ijson.items needs one fixed prefix, so first sniff whether VehicleMonitoringDelivery
+    # is a list or a dict, then replay those bytes into the C item builder.
+    reader = _ReplayReader(raw)
+    for prefix, event, _ in ijson.parse(reader, use_float=True):
+        if prefix == DELIVERY_PREFIX:
+            break
+    else:
+        return
+    reader.recording = False
+
+    if event == "start_array":
+        item_prefix = DELIVERY_PREFIX + ".item.VehicleActivity.item"
+    elif event == "start_map":
+        item_prefix = DELIVERY_PREFIX + ".VehicleActivity.item"
+    else:
+        return
+    yield from ijson.items(reader, item_prefix, use_float=True)
+
+
 def extract_vehicle_activities(payload: Dict[str, Any]) -> list:
-    """Handle VehicleMonitoringDelivery being a dict or a list."""
+    """Handle VehicleMonitoringDelivery being a dict or a list (activities of every delivery)."""
     try:
         deliveries = (
             payload.get("Siri", {})
@@ -266,95 +568,123 @@ def extract_vehicle_activities(payload: Dict[str, Any]) -> list:
         )
 
         # VehicleMonitoringDelivery may be list or dict
-        if isinstance(deliveries, list):
-            if not deliveries:
-                return []
-            deliveries = deliveries[0]
-
         if isinstance(deliveries, dict):
-            acts = deliveries.get("VehicleActivity", [])
-            return acts if isinstance(acts, list) else []
-
-        return []
+            deliveries = [deliveries]
+        if not isinstance(deliveries, list):
+            return []
+
+        acts: list = []
+        for delivery in deliveries:
+            if isinstance(delivery, dict) and isinstance(delivery.get("VehicleActivity"), list):
+                acts.extend(delivery["VehicleActivity"])
+        return acts
     except Exception:
         return []
 
 
-def extract_fields(activity: Dict[str, Any]) -> Optional[Tuple[str, str, str, str, str, datetime]]:
-    """Return (vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_dt) or None."""
-    recorded_at = parse_iso8601(activity.get("RecordedAtTime"))
-    mvj = activity.get("MonitoredVehicleJourney") or {}
+_EMPTY: Dict[str, Any] = {}
 
-    vehicle_ref = unwrap(mvj.get("VehicleRef"))
-    route_id = unwrap(mvj.get("LineRef")) or unwrap(mvj.get("PublishedLineName")) or ""
 
-    direction_id_val = unwrap(mvj.get("DirectionRef"))
-    direction_id = str(direction_id_val) if direction_id_val is not None else ""
+def extract_fields(activity: Dict[str, Any]) -> Optional[Tuple[str, str, str, str, str, int]]:
+    """Return (vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_us) or None."""
+    # Hot path (every activity, every tick): fields are almost always plain strings,
+    # so only call unwrap() for the {'value': ...} form, and check the required
+    # fields first so rejected activities stay cheap.
+    mvj = activity.get("MonitoredVehicleJourney") or _EMPTY
+    get = mvj.get
 
-    fref = mvj.get("FramedVehicleJourneyRef") or {}
-    trip_id = unwrap(fref.get("DatedVehicleJourneyRef")) or ""
+    # Required for stop-to-stop tracking
+    vehicle_ref = get("VehicleRef")
+    if type(vehicle_ref) is dict:
+        vehicle_ref = unwrap(vehicle_ref)
+    if not vehicle_ref:
+        return None
 
-    monitored_call = mvj.get("MonitoredCall") or {}
-    next_stop_id = unwrap(monitored_call.get("StopPointRef"))
+    next_stop_id = (get("MonitoredCall") or _EMPTY).get("StopPointRef")
+    if type(next_stop_id) is dict:
+        next_stop_id = unwrap(next_stop_id)
+    if not next_stop_id:
+        return None
 
-    # Required for stop-to-stop tracking
-    if not recorded_at or not vehicle_ref or not next_stop_id:
+    recorded_at = ts_to_epoch_us(activity.get("RecordedAtTime"))
+    if recorded_at is None:
         return None
 
+    route_id = get("LineRef")
+    if type(route_id) is dict:
+        route_id = unwrap(route_id)
+    if not route_id:
+        route_id = unwrap(get("PublishedLineName")) or ""
+
+    direction_id = get("DirectionRef")
+    if type(direction_id) is dict:
+        direction_id = unwrap(direction_id)
+    if direction_id is None:
+        direction_id = ""
+
+    trip_id = (get("FramedVehicleJourneyRef") or _EMPTY).get("DatedVehicleJourneyRef")
+    if type(trip_id) is dict:
+        trip_id = unwrap(trip_id)
+    if not trip_id:
+        trip_id = ""
+
     return (str(vehicle_ref), str(route_id), str(direction_id), str(trip_id), str(next_stop_id), recorded_at)
 
 
 # ----------------------------
 # CORE LOGIC
 # ----------------------------
-def handle_observation(conn: sqlite3.Connection, obs: Tuple[str, str, str, str, str, datetime]) -> None:
-    vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_dt = obs
-    recorded_at_utc = utc_iso(recorded_at_dt)
+def handle_observation(
+    obs: Tuple[str, str, str, str, str, int],
+    seg_rows: List[tuple],
+    state_rows: List[tuple],
+) -> None:
+    vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_us = obs
 
-    prev = load_vehicle_state(conn, vehicle_ref)
+    prev = load_vehicle_state(vehicle_ref)
 
     # First time seeing this bus
     if prev is None or not prev.get("current_stop_id"):
-        upsert_vehicle_state(conn, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_utc)
+        upsert_vehicle_state(state_rows, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_us)
         return
 
     prev_stop = prev["current_stop_id"]
-    prev_first_seen_dt = parse_iso8601(prev["current_stop_first_seen_utc"])
+    prev_first_seen_us = prev["current_stop_first_seen_us"]
 
     # If stop hasn't changed, just refresh metadata
     if next_stop_id == prev_stop:
-        upsert_vehicle_state(conn, vehicle_ref, route_id, direction_id, trip_id, prev_stop, prev["current_stop_first_seen_utc"])
+        upsert_vehicle_state(state_rows, vehicle_ref, route_id, direction_id, trip_id, prev_stop, prev_first_seen_us)
         return
 
     # Stop changed: treat as completion of segment prev_stop -> next_stop_id
-    if not prev_first_seen_dt:
+    if prev_first_seen_us is None:
         # Broken state; reset safely
-        upsert_vehicle_state(conn, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_utc)
+        upsert_vehicle_state(state_rows, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_us)
         return
 
-    travel_seconds = int((recorded_at_dt - prev_first_seen_dt).total_seconds())
+    travel_seconds = int((recorded_at_us - prev_first_seen_us) / 1_000_000)
 
     # Sanity checks
     if travel_seconds < MIN_SEGMENT_SECONDS or travel_seconds > MAX_SEGMENT_SECONDS:
-        upsert_vehicle_state(conn, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_utc)
+        upsert_vehicle_state(state_rows, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_us)
         return
 
-    # Save immediately (no prediction)
+    # Queue for the writer thread (no prediction)
     insert_segment(
-        conn=conn,
+        seg_rows=seg_rows,
         route_id=prev.get("route_id", route_id) or route_id,
         direction_id=prev.get("direction_id", direction_id) or direction_id,
         vehicle_ref=vehicle_ref,
         trip_id=prev.get("trip_id", trip_id) or trip_id,
         from_stop=prev_stop,
         to_stop=next_stop_id,
-        depart_utc=prev["current_stop_first_seen_utc"],
-        arrive_utc=recorded_at_utc,
+        depart_utc=epoch_us_to_iso(prev_first_seen_us),
+        arrive_utc=epoch_us_to_iso(recorded_at_us),
         travel_seconds=travel_seconds,
     )
 
     # Update state to new next stop
-    upsert_vehicle_state(conn, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_utc)
+    upsert_vehicle_state(state_rows, vehicle_ref, route_id, direction_id, trip_id, next_stop_id, recorded_at_us)
 
 
 # ----------------------------
@@ -373,47 +703,104 @@ def main() -> None:
 
     conn = db_connect()
     db_init(conn)
+    prime_vehicle_state(conn)
+    logging.info(f"Loaded state for {len(STATE)} vehicles")
+
+    # Ticks are handed to one writer thread (SQLite stays single-writer), so a
+    # tick's commit runs during the wait/fetch of the next one and polls start on
+    # a fixed POLL_SECONDS cadence.
+    write_queue: queue.Queue = queue.Queue(maxsize=2)
+    dropped = threading.Event()  # set by the writer when it drops a tick
+    writer = threading.Thread(target=db_writer, args=(write_queue, dropped), name="db-writer", daemon=True)
+    writer.start()
 
     sample_logged = False
+    failures = 0  # consecutive network/API failures
+    resync = False  # STATE ran ahead of the queued rows in an interrupted tick
 
-    while True:
-        try:
-            payload = fetch_vehicle_monitoring()
-            activities = extract_vehicle_activities(payload)
-
-            # Optional debug: print sample structure once
-            if DEBUG_SAMPLE and activities and not sample_logged:
-                sample = activities[0]
-                mvj = sample.get("MonitoredVehicleJourney", {})
-                logging.info(f"Sample VehicleActivity keys: {list(sample.keys())}")
-                logging.info(f"Sample MVJ keys: {list(mvj.keys())}")
-                logging.info(f"Sample MonitoredCall: {mvj.get('MonitoredCall')}")
-                sample_logged = True
-
-            processed = 0
-            skipped = 0
-
-            for act in activities:
-                obs = extract_fields(act)
-                if obs is None:
-                    skipped += 1
-                    continue
-                try:
-                    handle_observation(conn, obs)
-                    processed += 1
-                except Exception:
-                    skipped += 1
+    try:
+        while True:
+            tick_started = time.monotonic()
+            delay = POLL_SECONDS
+
+            if resync or dropped.is_set():
+                write_queue.join()
+                dropped.clear()
+                resync = False
+                prime_vehicle_state(conn)
+                logging.warning("Reloaded vehicle state from DB after an interrupted tick or dropped write")
+
+            seg_rows: List[tuple] = []
+            state_rows: List[tuple] = []
+
+            try:
+                fetched = fetch_vehicle_monitoring()
+                if fetched is None:
+                    failures = 0
+                    logging.info("Tick: feed unchanged since last poll (304), skipping")
+                    time.sleep(max(0.0, delay - (time.monotonic() - tick_started)))
                     continue
 
-            conn.commit()
-            logging.info(f"Tick: processed={processed}, skipped={skipped}, vehicles_seen={len(activities)}")
-
-        except requests.RequestException as e:
-            logging.error(f"Network/API error: {e}")
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-
-        time.sleep(POLL_SECONDS)
+                resp, validators = fetched
+                processed = 0
+                skipped = 0
+                vehicles_seen = 0
+
+                for act in iter_vehicle_activities(resp):
+                    vehicles_seen += 1
+
+                    # Optional debug: print sample structure once
+                    if DEBUG_SAMPLE and not sample_logged:
+                        mvj = act.get("MonitoredVehicleJourney", {})
+                        logging.info(f"Sample VehicleActivity keys: {list(act.keys())}")
+                        logging.info(f"Sample MVJ keys: {list(mvj.keys())}")
+                        logging.info(f"Sample MonitoredCall: {mvj.get('MonitoredCall')}")
+                        sample_logged = True
+
+                    obs = extract_fields(act)
+                    if obs is None:
+                        skipped += 1
+                        continue
+                    try:
+                        handle_observation(obs, seg_rows, state_rows)
+                        processed += 1
+                    except Exception:
+                        skipped += 1
+                        continue
+
+                failures = 0  # only once the whole body has been read
+                # Likewise adopt the new validators only now: if the read had failed, the
+                # next poll must not 304 away a payload that was never ingested.
+                CONDITIONAL_HEADERS.clear()
+                CONDITIONAL_HEADERS.update(validators)
+                write_queue.put((seg_rows, state_rows))
+                logging.info(
+                    f"Tick: processed={processed}, skipped={skipped}, segments={len(seg_rows)}, "
+                    f"vehicles_seen={vehicles_seen}"
+                )
+
+            except requests.RequestException as e:
+                failures += 1
+                delay = backoff_seconds(failures, e)
+                logging.error(f"Network/API error ({failures} in a row, next poll in {delay:.0f}s): {e}")
+                # A half-read tick may have advanced STATE for rows that were never queued.
+                resync = bool(state_rows)
+            except Exception as e:
+                logging.error(f"Unexpected error: {e}")
+                resync = bool(state_rows)
+
+            time.sleep(max(0.0, delay - (time.monotonic() - tick_started)))
+    finally:
+        # Flush whatever is still queued before exiting, unless the writer is stuck
+        # retrying a busy DB (it is a daemon thread, so exiting abandons it).
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+        try:
+            write_queue.put(None, timeout=SHUTDOWN_TIMEOUT_SECONDS)
+            writer.join(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        if writer.is_alive():
+            logging.warning("DB writer still busy; exiting without flushing queued ticks")
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import os
+import math
 import sqlite3
 import logging
+import statistics
 from datetime import datetime
 
 DB_PATH = os.getenv("METROMIND_DB", "/workspaces/MetroMind/metromind_memory.sqlite")
@@ -12,6 +14,10 @@ MAX_SECONDS = int(os.getenv("PHASE5_MAX_SECONDS", "1800"))  # 30 minutes per sto
 # Robust outlier filter settings
 MAD_Z_CUTOFF = float(os.getenv("PHASE5_MAD_Z_CUTOFF", "6.0"))  # 6 is fairly lenient
 
+# Reprocess all history instead of only segments added since the last run
+# (needed after changing the bounds / cutoff above).
+FULL_REBUILD = os.getenv("PHASE5_FULL_REBUILD", "0") == "1"
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
@@ -19,228 +25,296 @@ def connect():
     conn = sqlite3.connect(DB_PATH)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")            # collector and phase5 share the DB
+    conn.execute("PRAGMA cache_size=-65536;")           # 64 MiB page cache
+    conn.execute("PRAGMA mmap_size=268435456;")         # 256 MiB memory-mapped reads
+    conn.execute("PRAGMA temp_store=MEMORY;")           # temp tables / sorts stay in RAM
+    conn.execute("PRAGMA wal_autocheckpoint=2000;")
     return conn
 
 
 def init_phase5_tables(conn: sqlite3.Connection):
-    # Cleaned segments table
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS segments_clean (
-        id INTEGER PRIMARY KEY,                  -- same as raw segments.id
-        route_id TEXT,
-        direction_id TEXT,
-        vehicle_ref TEXT,
-        trip_id TEXT,
-        from_stop_id TEXT NOT NULL,
-        to_stop_id TEXT NOT NULL,
-        depart_time_utc TEXT NOT NULL,
-        arrive_time_utc TEXT NOT NULL,
-        travel_time_seconds INTEGER NOT NULL,
-
-        -- derived time categories
-        day_of_week INTEGER NOT NULL,            -- 0=Mon ... 6=Sun (UTC based)
-        hour_of_day INTEGER NOT NULL,            -- 0..23 (UTC based)
-        time_bucket TEXT NOT NULL,               -- e.g. "Mon-17"
-
-        -- cleaning metadata
-        is_outlier INTEGER NOT NULL              -- 0/1
-    )
-    """)
-
-    # Per-segment-key stats / coverage
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS segment_stats (
-        route_id TEXT,
-        direction_id TEXT,
-        from_stop_id TEXT,
-        to_stop_id TEXT,
-        day_of_week INTEGER,
-        hour_of_day INTEGER,
-        time_bucket TEXT,
-
-        sample_count INTEGER NOT NULL,
-        median_seconds REAL,
-        mad_seconds REAL,
-        p10_seconds REAL,
-        p90_seconds REAL,
-
-        PRIMARY KEY (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day)
-    )
-    """)
-    conn.commit()
+    # One transaction, so the segment_stats drop and the watermark reset below commit
+    # together: otherwise a failure in between (e.g. busy_timeout on the index build)
+    # leaves later runs working incrementally against an empty segment_stats.
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        # Cleaned segments table
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS segments_clean (
+            id INTEGER PRIMARY KEY,                  -- same as raw segments.id
+            route_id TEXT,
+            direction_id TEXT,
+            vehicle_ref TEXT,
+            trip_id TEXT,
+            from_stop_id TEXT NOT NULL,
+            to_stop_id TEXT NOT NULL,
+            depart_time_utc TEXT NOT NULL,
+            arrive_time_utc TEXT NOT NULL,
+            travel_time_seconds INTEGER NOT NULL,
+
+            -- derived time categories
+            day_of_week INTEGER NOT NULL,            -- 0=Mon ... 6=Sun (UTC based)
+            hour_of_day INTEGER NOT NULL,            -- 0..23 (UTC based)
+            time_bucket TEXT NOT NULL,               -- e.g. "Mon-17"
+
+            -- cleaning metadata
+            is_outlier INTEGER NOT NULL              -- 0/1
+        )
+        """)
+
+        # Watermark: highest segments.id already folded into segments_clean / segment_stats
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS phase5_state (
+            last_id INTEGER NOT NULL
+        )
+        """)
+
+        # Per-segment-key stats / coverage, clustered on the key so the segments_clean
+        # join is a direct primary-key search.
+        # Older DBs created it as a rowid table; it is derived data, so drop it and reset
+        # the watermark to trigger a full rebuild.
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'segment_stats';").fetchone()
+        rebuild_stats = row is not None and "WITHOUT ROWID" not in row[0].upper()
+        if rebuild_stats:
+            logging.info("Recreating segment_stats as a WITHOUT ROWID table (full rebuild)")
+            conn.execute("DELETE FROM phase5_state;")
+            conn.execute("DROP TABLE segment_stats;")
+
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS segment_stats (
+            route_id TEXT,
+            direction_id TEXT,
+            from_stop_id TEXT,
+            to_stop_id TEXT,
+            day_of_week INTEGER,
+            hour_of_day INTEGER,
+            time_bucket TEXT,
+
+            sample_count INTEGER NOT NULL,
+            median_seconds REAL,
+            mad_seconds REAL,
+            p10_seconds REAL,
+            p90_seconds REAL,
+
+            PRIMARY KEY (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day)
+        ) WITHOUT ROWID
+        """)
+
+        # Lets an incremental run pull just the history of the dirty stop pairs.
+        # Stop ids are NOT NULL raw columns, unlike the COALESCE'd route/direction.
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_segments_pair
+        ON segments (from_stop_id, to_stop_id)
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_last_processed_id(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT last_id FROM phase5_state;").fetchone()
+    return row[0] if row else 0
+
+
+def set_last_processed_id(conn: sqlite3.Connection, last_id: int):
+    conn.execute("DELETE FROM phase5_state;")
+    conn.execute("INSERT INTO phase5_state (last_id) VALUES (?);", (last_id,))
 
 
 def build_clean_and_stats(conn: sqlite3.Connection):
     """
     Pipeline:
-    1) Build a temp working table with derived time buckets.
-    2) Hard-filter impossible values.
-    3) Compute robust stats per (route, dir, from, to, day, hour).
+    1) Find the (route, dir, from, to, day, hour) keys touched by segments added
+       since the last run (all keys on the first run / PHASE5_FULL_REBUILD=1).
+    2) Build a temp working table with every segment of those keys, with derived
+       time buckets, hard-filtering impossible values on the way in.
+    3) Compute robust stats per key.
     4) Mark outliers using modified z-score with MAD.
-    5) Write segments_clean + segment_stats.
+    5) Replace those keys' rows in segments_clean + segment_stats and advance the watermark.
     """
+    last_id = 0 if FULL_REBUILD else get_last_processed_id(conn)
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM segments;").fetchone()[0]
+    if max_id <= last_id:
+        logging.info(f"No new segments since id {last_id}; nothing to do.")
+        return
 
-    # 0) temp working table from raw segments
-    conn.execute("DROP TABLE IF EXISTS segments_work;")
+    logging.info(f"Processing segments with id {last_id + 1}..{max_id}")
 
+    # Raw segments + derived time categories.
     # day_of_week/hour_of_day in UTC derived from arrive_time_utc (you could also use depart_time_utc)
-    conn.execute(f"""
-    CREATE TEMP TABLE segments_work AS
+    conn.execute("DROP VIEW IF EXISTS segments_derived;")
+    conn.execute("""
+    CREATE TEMP VIEW segments_derived AS
     SELECT
-        id,
-        COALESCE(route_id, '') AS route_id,
-        COALESCE(direction_id, '') AS direction_id,
-        COALESCE(vehicle_ref, '') AS vehicle_ref,
-        COALESCE(trip_id, '') AS trip_id,
-        from_stop_id,
-        to_stop_id,
-        depart_time_utc,
-        arrive_time_utc,
-        travel_time_seconds,
-
-        CAST(strftime('%w', arrive_time_utc) AS INTEGER) AS sqlite_dow,  -- 0=Sun..6=Sat
-        CAST(strftime('%H', arrive_time_utc) AS INTEGER) AS hour_of_day
-    FROM segments
-    WHERE travel_time_seconds IS NOT NULL;
+        *,
+        substr('MonTueWedThuFriSatSun', day_of_week * 3 + 1, 3) || '-' || printf('%02d', hour_of_day) AS time_bucket
+    FROM (
+        SELECT
+            id,
+            COALESCE(route_id, '') AS route_id,
+            COALESCE(direction_id, '') AS direction_id,
+            COALESCE(vehicle_ref, '') AS vehicle_ref,
+            COALESCE(trip_id, '') AS trip_id,
+            from_stop_id,
+            to_stop_id,
+            depart_time_utc,
+            arrive_time_utc,
+            travel_time_seconds,
+
+            -- strftime('%w') is 0=Sun..6=Sat; convert to 0=Mon..6=Sun
+            (CAST(strftime('%w', arrive_time_utc) AS INTEGER) + 6) % 7 AS day_of_week,
+            CAST(strftime('%H', arrive_time_utc) AS INTEGER) AS hour_of_day
+        FROM segments
+    );
     """)
 
-    # Convert sqlite_dow (0=Sun) to 0=Mon..6=Sun
-    conn.execute("""
-    ALTER TABLE segments_work ADD COLUMN day_of_week INTEGER;
-    """)
-    conn.execute("""
-    UPDATE segments_work
-    SET day_of_week = CASE
-        WHEN sqlite_dow = 0 THEN 6
-        ELSE sqlite_dow - 1
-    END;
-    """)
+    conn.execute("DROP TABLE IF EXISTS segments_work;")
 
-    conn.execute("""
-    ALTER TABLE segments_work ADD COLUMN time_bucket TEXT;
-    """)
-    conn.execute("""
-    UPDATE segments_work
-    SET time_bucket =
-        CASE day_of_week
-            WHEN 0 THEN 'Mon'
-            WHEN 1 THEN 'Tue'
-            WHEN 2 THEN 'Wed'
-            WHEN 3 THEN 'Thu'
-            WHEN 4 THEN 'Fri'
-            WHEN 5 THEN 'Sat'
-            WHEN 6 THEN 'Sun'
-        END || '-' || printf('%02d', hour_of_day);
-    """)
+    if last_id == 0:
+        # Full rebuild
+        conn.execute("DELETE FROM segment_stats;")
+        conn.execute("DELETE FROM segments_clean;")
+
+        conn.execute("""
+        CREATE TEMP TABLE segments_work AS
+        SELECT *
+        FROM segments_derived
+        WHERE id <= ?
+          AND travel_time_seconds BETWEEN ? AND ?
+          AND arrive_time_utc IS NOT NULL;
+        """, (max_id, MIN_SECONDS, MAX_SECONDS))
+    else:
+        # 1) keys touched by the new tail
+        conn.execute("DROP TABLE IF EXISTS dirty_keys;")
+        conn.execute("""
+        CREATE TEMP TABLE dirty_keys AS
+        SELECT DISTINCT route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day
+        FROM segments_derived
+        WHERE id > ? AND id <= ?
+          AND travel_time_seconds BETWEEN ? AND ?
+          AND day_of_week IS NOT NULL
+          AND hour_of_day IS NOT NULL;
+        """, (last_id, max_id, MIN_SECONDS, MAX_SECONDS))
+        n_dirty = conn.execute("SELECT COUNT(*) FROM dirty_keys;").fetchone()[0]
+        logging.info(f"Keys to recompute: {n_dirty:,}")
+
+        # 2) full history of just those keys, found through ix_segments_pair
+        conn.execute("""
+        CREATE TEMP TABLE segments_work AS
+        SELECT s.*
+        FROM (SELECT DISTINCT from_stop_id, to_stop_id FROM dirty_keys) p
+        CROSS JOIN segments_derived s
+          ON s.from_stop_id = p.from_stop_id
+         AND s.to_stop_id = p.to_stop_id
+        WHERE s.id <= ?
+          AND s.travel_time_seconds BETWEEN ? AND ?
+          AND s.arrive_time_utc IS NOT NULL
+          AND (s.route_id, s.direction_id, s.from_stop_id, s.to_stop_id, s.day_of_week, s.hour_of_day) IN (
+              SELECT route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day FROM dirty_keys
+          );
+        """, (max_id, MIN_SECONDS, MAX_SECONDS))
+
+        # segment_stats is keyed on the stats key; segments_clean rows of those keys
+        # are exactly segments_work's ids (the key is derived from the row itself).
+        conn.execute("""
+        DELETE FROM segment_stats
+        WHERE (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day) IN (
+            SELECT route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day FROM dirty_keys
+        );
+        """)
+        conn.execute("""
+        DELETE FROM segments_clean
+        WHERE id IN (SELECT id FROM segments_work);
+        """)
 
-    # 1) hard bounds filter (removes obvious glitches)
-    conn.execute("DROP TABLE IF EXISTS segments_work2;")
-    conn.execute(f"""
-    CREATE TEMP TABLE segments_work2 AS
-    SELECT *
-    FROM segments_work
-    WHERE travel_time_seconds BETWEEN {MIN_SECONDS} AND {MAX_SECONDS};
+    compute_stats_sql(conn)
+
+    set_last_processed_id(conn, max_id)
+    conn.commit()
+
+
+class MedianAgg:
+    """SQLite aggregate median(x): exact median (mean of the two middle values for even n)."""
+
+    def __init__(self):
+        self.xs = []
+
+    def step(self, x):
+        if x is not None:
+            self.xs.append(x)
+
+    def finalize(self):
+        return statistics.median(self.xs) if self.xs else None
+
+
+class MadAgg(MedianAgg):
+    """SQLite aggregate mad(x) = median(|x - median(x)|)."""
+
+    def finalize(self):
+        if not self.xs:
+            return None
+        m = statistics.median(self.xs)
+        return statistics.median([abs(x - m) for x in self.xs])
+
+
+class PercentileAgg:
+    """SQLite aggregate percentile(x, p): nearest-rank, i.e. the ceil(n * p)-th smallest x."""
+
+    def __init__(self):
+        self.xs = []
+        self.p = None
+
+    def step(self, x, p):
+        self.p = p
+        if x is not None:
+            self.xs.append(x)
+
+    def finalize(self):
+        if not self.xs:
+            return None
+        self.xs.sort()
+        return self.xs[max(math.ceil(len(self.xs) * self.p), 1) - 1]
+
+
+def compute_stats_sql(conn: sqlite3.Connection):
+    """Fill segment_stats + segments_clean from segments_work in SQL, using Python aggregates."""
+    # Index the stats key (+ value) so the GROUP BY and the outlier join can walk it in order.
+    conn.execute("""
+    CREATE INDEX ix_work_key ON segments_work (
+        route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, travel_time_seconds
+    );
     """)
+    conn.execute("ANALYZE segments_work;")
 
-    # 2) Compute median and MAD per key
-    # SQLite doesn't have MEDIAN built-in, so we do a deterministic median using ordered subqueries.
-    # We compute:
-    # - median (50th percentile)
-    # - p10, p90 (approx using rank)
-    # - MAD = median(|x - median|)
-    conn.execute("DELETE FROM segment_stats;")
+    # 3) Compute median, MAD and p10/p90 per key
+    # SQLite doesn't have MEDIAN built-in, so register small Python aggregates for it.
+    conn.create_aggregate("median", 1, MedianAgg)
+    conn.create_aggregate("mad", 1, MadAgg)
+    conn.create_aggregate("percentile", 2, PercentileAgg)
 
     conn.execute("""
     INSERT OR REPLACE INTO segment_stats (
         route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
         sample_count, median_seconds, mad_seconds, p10_seconds, p90_seconds
     )
-    WITH
-    base AS (
-        SELECT
-            route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
-            travel_time_seconds AS x
-        FROM segments_work2
-    ),
-    counts AS (
-        SELECT
-            route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
-            COUNT(*) AS n
-        FROM base
-        GROUP BY route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day
-    ),
-    ranked AS (
-        SELECT
-            b.*,
-            c.n,
-            ROW_NUMBER() OVER (
-                PARTITION BY b.route_id, b.direction_id, b.from_stop_id, b.to_stop_id, b.day_of_week, b.hour_of_day
-                ORDER BY b.x
-            ) AS rn
-        FROM base b
-        JOIN counts c USING (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket)
-    ),
-    med AS (
-        SELECT
-            route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
-            n,
-            AVG(x) AS median_seconds
-        FROM ranked
-        WHERE rn IN ((n + 1) / 2, (n + 2) / 2)   -- handles even/odd
-        GROUP BY route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day
-    ),
-    pcts AS (
-        SELECT
-            route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
-            MAX(CASE WHEN rn = CAST(CEIL(n * 0.10) AS INTEGER) THEN x END) AS p10_seconds,
-            MAX(CASE WHEN rn = CAST(CEIL(n * 0.90) AS INTEGER) THEN x END) AS p90_seconds
-        FROM ranked
-        GROUP BY route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day
-    ),
-    absdev AS (
-        SELECT
-            r.route_id, r.direction_id, r.from_stop_id, r.to_stop_id, r.day_of_week, r.hour_of_day, r.time_bucket,
-            r.n,
-            ABS(r.x - m.median_seconds) AS d
-        FROM ranked r
-        JOIN med m USING (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket)
-    ),
-    absrank AS (
-        SELECT
-            a.*,
-            ROW_NUMBER() OVER (
-                PARTITION BY a.route_id, a.direction_id, a.from_stop_id, a.to_stop_id, a.day_of_week, a.hour_of_day
-                ORDER BY a.d
-            ) AS drn
-        FROM absdev a
-    ),
-    mad AS (
-        SELECT
-            route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
-            AVG(d) AS mad_seconds
-        FROM absrank
-        WHERE drn IN ((n + 1) / 2, (n + 2) / 2)
-        GROUP BY route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day
-    )
     SELECT
-        c.route_id, c.direction_id, c.from_stop_id, c.to_stop_id, c.day_of_week, c.hour_of_day, c.time_bucket,
-        c.n AS sample_count,
-        m.median_seconds,
-        mad.mad_seconds,
-        p.p10_seconds,
-        p.p90_seconds
-    FROM counts c
-    JOIN med m USING (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket)
-    LEFT JOIN mad USING (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket)
-    LEFT JOIN pcts p USING (route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket);
+        route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day, time_bucket,
+        COUNT(*),
+        median(travel_time_seconds),
+        mad(travel_time_seconds),
+        percentile(travel_time_seconds, 0.10),
+        percentile(travel_time_seconds, 0.90)
+    FROM segments_work
+    WHERE day_of_week IS NOT NULL AND hour_of_day IS NOT NULL
+    GROUP BY route_id, direction_id, from_stop_id, to_stop_id, day_of_week, hour_of_day;
     """)
 
-    # 3) Build segments_clean by joining stats and marking outliers using modified z-score with MAD
+    # 4) Build segments_clean by joining stats and marking outliers using modified z-score with MAD
     # modified_z = 0.6745 * (x - median) / MAD
     # If MAD == 0 (all identical), we never mark outliers from MAD; only hard bounds already applied.
-    conn.execute("DELETE FROM segments_clean;")
-
-    conn.execute(f"""
+    conn.execute("""
     INSERT INTO segments_clean (
         id, route_id, direction_id, vehicle_ref, trip_id,
         from_stop_id, to_stop_id, depart_time_utc, arrive_time_utc, travel_time_seconds,
@@ -253,10 +327,10 @@ def build_clean_and_stats(conn: sqlite3.Connection):
         w.day_of_week, w.hour_of_day, w.time_bucket,
         CASE
             WHEN s.mad_seconds IS NULL OR s.mad_seconds = 0 THEN 0
-            WHEN ABS(0.6745 * (w.travel_time_seconds - s.median_seconds) / s.mad_seconds) > {MAD_Z_CUTOFF} THEN 1
+            WHEN ABS(0.6745 * (w.travel_time_seconds - s.median_seconds) / s.mad_seconds) > ? THEN 1
             ELSE 0
         END AS is_outlier
-    FROM segments_work2 w
+    FROM segments_work w
     JOIN segment_stats s
       ON s.route_id = w.route_id
      AND s.direction_id = w.direction_id
@@ -264,9 +338,7 @@ def build_clean_and_stats(conn: sqlite3.Connection):
      AND s.to_stop_id = w.to_stop_id
      AND s.day_of_week = w.day_of_week
      AND s.hour_of_day = w.hour_of_day;
-    """)
-
-    conn.commit()
+    """, (MAD_Z_CUTOFF,))
 
 
 def print_coverage_reports(conn: sqlite3.Connection):
@@ -320,6 +392,8 @@ def main():
     logging.info(f"DB: {DB_PATH}")
     logging.info(f"Hard bounds: {MIN_SECONDS}s..{MAX_SECONDS}s")
     logging.info(f"MAD z cutoff: {MAD_Z_CUTOFF}")
+    if FULL_REBUILD:
+        logging.info("Full rebuild requested (PHASE5_FULL_REBUILD=1)")
 
     conn = connect()
     init_phase5_tables(conn)